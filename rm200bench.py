@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+# Licensed under AGPL 3.0 https://www.gnu.org/licenses/agpl-3.0.en.html
+
+# Benchmarks for rm200lib, run against a fake device so no hardware is needed.
+#
+# Covers decoding (and encoding) of synthetic record, fandeck and Versions.dat payloads of
+# growing count and size on their own, the same commands including their transfers, file
+# transfers of a range of sizes and plain command round trips, with a configurable
+# per transfer latency to mimic the usb link. Results (best time and peak memory) are
+# saved as json, and can be compared against a previous run to catch regressions.
+# File transfers are chunked to fit the device buffer (--commsize, 140 by default as in
+# rm200lib), so with latency set the large transfers take a while, use --only to pick:
+#
+#   ./rm200bench.py --output baseline.json
+#   ./rm200bench.py --baseline baseline.json --threshold 0.2
+#
+# Exits with status 1 if any benchmark is slower (or uses more memory) than the baseline
+# by more than the threshold.
+
+import sys
+import json
+import time
+import array
+import argparse
+import tracemalloc
+import rm200lib as rm
+
+# pretends to be a usb.core.Device, just enough for the rm200lib commands
+# responses are built when the command is written and returned by the following read
+class FakeDevice:
+    def __init__(self, latency = 0.0, commsize = 140):
+        self.latency = latency
+        self.commsize = commsize
+        self.files = {}
+        self.records = []
+        self.fandecks = b''
+        self.response = b''
+        self.open_name = None
+        self.open_data = None
+        self.open_pos = 0
+
+    def ctrl_transfer(self, bmRequestType, bRequest, wValue = 0, wIndex = 0, data_or_wLength = None, timeout = None):
+        return 0
+
+    def write(self, endpoint, data, timeout = None):
+        if self.latency:
+            time.sleep(self.latency)
+        data = bytes(data)
+        self.response = self.Handle(data[:2], data[2:])
+        return len(data)
+
+    def read(self, endpoint, size, timeout = None):
+        if self.latency:
+            time.sleep(self.latency)
+        return array.array('B', self.response)
+
+    def Handle(self, cmd, args):
+        ok = b'\x00\x00\x33\x01'
+        match cmd:
+            case b'\x78\x11':
+                return ok + self.commsize.to_bytes(4, 'big')
+            case b'\x78\x19':
+                return ok + len(self.records).to_bytes(2, 'big')
+            case b'\x78\x20':
+                return ok + self.records[int.from_bytes(args[:2], 'big')]
+            case b'\x78\x21':
+                return ok + self.fandecks
+            case b'\x77\x20':
+                self.open_name = args[1:-1].decode()
+                self.open_pos = 0
+                if args[0] == 1:
+                    self.open_data = self.files[self.open_name]
+                else:
+                    self.open_data = bytearray()
+                return ok
+            case b'\x77\x22':
+                chunk = self.open_data[self.open_pos : self.open_pos + self.commsize - 8]
+                self.open_pos += len(chunk)
+                return ok + len(chunk).to_bytes(4, 'big') + chunk
+            case b'\x77\x23':
+                self.open_data += args[4:]
+                return ok
+            case b'\x77\x21':
+                if isinstance(self.open_data, bytearray):
+                    self.files[self.open_name] = bytes(self.open_data)
+                self.open_name = None
+                return ok
+            case b'\x77\x14':
+                return ok
+        return b'\x00\x00\x33\x02'
+
+def _Utf16(string):
+    return string.encode('utf-16le') + b'\0\0'
+
+# a saved sample record, as returned by GetRecordData, with a thumbnail of BGR565 pixels
+def MakeRecord(num, pixels = 10000):
+    data = b'\x00\x01' + (2024).to_bytes(2, 'big') + bytes([5, 17, 12, 30, num % 60]) + bytes(6)
+    for string in ['Fandeck ' + str(num), 'C' + str(num), '12', '3', '4', 'Colour name ' + str(num), '', 'P12', '', '']:
+        data += _Utf16(string)
+    return data + b'\x00\x02' + bytes(pixels * 2)
+
+# a fandeck list, as returned by GetFandecks, with count fandecks
+def MakeFandecks(count):
+    data = [b'\x00\x01', count.to_bytes(2, 'big')]
+    for i in range(count):
+        data.append(_Utf16('Fandeck ' + str(i)) + bytes([i % 3]))
+        for string in ['SKU' + str(i), 'Description of fandeck ' + str(i), '1.0', 'x', 'y', 'z', 'fandeck' + str(i) + '.fdk']:
+            data.append(_Utf16(string))
+        data.append(i.to_bytes(4, 'big'))
+    return b''.join(data)
+
+# a Versions.dat file list, as used by WriteVersionsDotDat, with count entries
+def MakeVersions(count):
+    return [[7, str(i), 'Fandeck ' + str(i), 'SKU' + str(i), 'Description of file ' + str(i), '1.0.' + str(i),
+             1000 + i, 'file' + str(i) + '.dat'] for i in range(count)]
+
+# install a fake device as the rm200lib connection
+# commsize is the buffer size it reports, which sets the file transfer chunk size
+def FakeConnect(latency, commsize = 140):
+    fake = FakeDevice(latency, commsize)
+    rm.dev = fake
+    rm.GetComBufSize()
+    return fake
+
+# returns the best time of repeat runs, and the peak memory allocated by one run
+def Measure(func, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {'seconds': min(times), 'peak_bytes': peak}
+
+def Benchmarks(latency, commsize):
+    fake = FakeConnect(latency, commsize)
+    benchmarks = {}
+
+    # decoders on their own, with prebuilt payloads growing in count and in size
+    for count in [10, 100, 1000]:
+        def DecodeRecords(records=[MakeRecord(n) for n in range(count)]):
+            for record in records:
+                rm.DecodeRecordData(record)
+        benchmarks['decode_records_' + str(count)] = [DecodeRecords, None]
+
+        def DecodeFandecks(data=MakeFandecks(count)):
+            rm.DecodeFandecks(data)
+        benchmarks['decode_fandecks_' + str(count)] = [DecodeFandecks, None]
+
+        def EncodeVersions(versions=MakeVersions(count)):
+            rm.EncodeVersionsDotDat(versions)
+        benchmarks['encode_versions_dat_' + str(count)] = [EncodeVersions, None]
+
+        def DecodeVersions(data=rm.EncodeVersionsDotDat(MakeVersions(count))):
+            rm.DecodeVersionsDotDat(data)
+        benchmarks['decode_versions_dat_' + str(count)] = [DecodeVersions, None]
+
+    # records of growing size (thumbnail bytes)
+    for pixels in [1000, 10000, 100000]:
+        def DecodeRecordSize(records=[MakeRecord(n, pixels) for n in range(100)]):
+            for record in records:
+                rm.DecodeRecordData(record)
+        benchmarks['decode_records_100_' + str(pixels * 2)] = [DecodeRecordSize, None]
+
+    # whole commands, including the (fake) transfers
+    def GetRecords():
+        for n in range(100):
+            rm.GetRecordData(n)
+    benchmarks['get_records_100'] = [GetRecords, lambda: setattr(fake, 'records', [MakeRecord(n) for n in range(100)])]
+
+    def GetFandecks():
+        rm.GetFandecks()
+    benchmarks['get_fandecks_100'] = [GetFandecks, lambda: setattr(fake, 'fandecks', MakeFandecks(100))]
+
+    def VersionsRoundTrip(versions=MakeVersions(100)):
+        rm.WriteVersionsDotDat(versions)
+        rm.ReadVersionsDotDat()
+    benchmarks['versions_dat_round_trip_100'] = [VersionsRoundTrip, None]
+
+    for size in [1024, 65536, 1048576, 8388608]:
+        data = bytes(size)
+        def Transfer(data=data):
+            rm.PutFile('bench.bin', data)
+            rm.FetchFile('bench.bin')
+        benchmarks['transfer_' + str(size)] = [Transfer, None]
+
+    def Command():
+        rm.Reboot()
+    benchmarks['command_round_trip'] = [Command, None]
+
+    return benchmarks
+
+def Run(latency, commsize, repeat, only):
+    results = {}
+    for name, [func, setup] in Benchmarks(latency, commsize).items():
+        if only and only not in name:
+            continue
+        if setup:
+            setup()
+        results[name] = Measure(func, repeat)
+        print(f"{name:28} {results[name]['seconds'] * 1000:10.3f} ms {results[name]['peak_bytes'] / 1024:10.1f} KiB")
+    return results
+
+# returns array of messages for results that are worse than the baseline by more than threshold
+# (and by more than a little noise, so tiny benchmarks don't fail on timer jitter)
+def Compare(results, baseline, threshold):
+    noise = {'seconds': 0.0005, 'peak_bytes': 1024}
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for key in ['seconds', 'peak_bytes']:
+            if result[key] > baseline[name][key] * (1 + threshold) + noise[key]:
+                regressions.append(f'{name} {key}: {result[key]:.6g} vs baseline {baseline[name][key]:.6g}')
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark rm200lib against a fake device')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to each usb transfer')
+    parser.add_argument('--commsize', type=int, default=140, help='buffer size reported by the fake device, sets file transfer chunk size')
+    parser.add_argument('--repeat', type=int, default=5, help='runs of each benchmark, best time is kept')
+    parser.add_argument('--only', help='only run benchmarks with this in the name')
+    parser.add_argument('--output', help='save results to this json file')
+    parser.add_argument('--baseline', help='json results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed slowdown over baseline (0.25 = 25%%)')
+    args = parser.parse_args()
+
+    results = Run(args.latency, args.commsize, args.repeat, args.only)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'latency': args.latency, 'commsize': args.commsize, 'results': results}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['latency'] != args.latency:
+            print('Warning: baseline was run with latency ' + str(baseline['latency']))
+        if baseline.get('commsize') != args.commsize:
+            print('Warning: baseline was run with commsize ' + str(baseline.get('commsize')))
+        regressions = Compare(results, baseline['results'], args.threshold)
+        if len(regressions) > 0:
+            print('Regressions:')
+            print('\n'.join(regressions))
+            return 1
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
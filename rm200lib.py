@@ -3,16 +3,41 @@
 # richardaburton@gmail.com
 
 import os
+import csv
+import atexit
+import array
+import json
+import time
+import queue
+import base64
 import struct
+import warnings
+import threading
+import http.server
+import urllib.parse
+import collections
+import multiprocessing
+import concurrent.futures
 import usb.core
 
+# numpy is only needed by the calibration analysis functions
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 dev = None
 commsize = 140
 debug = False
 
-def Connect():
+# connect to the first RM200 found, or a specific one by bus and address (see FindDevices)
+def Connect(bus = None, address = None):
     global dev
-    dev = usb.core.find(idVendor=0x0765, idProduct=0x6001)
+    StopTrace()
+    if bus == None:
+        dev = usb.core.find(idVendor=0x0765, idProduct=0x6001)
+    else:
+        dev = usb.core.find(idVendor=0x0765, idProduct=0x6001, bus=bus, address=address)
     if dev is None:
         raise Exception('No RM200 found')
 
@@ -24,15 +49,201 @@ def Connect():
 
 def Disconnect():
     global dev
-    if dev != None:
+    StopTrace()
+    if isinstance(dev, usb.core.Device):
         usb.util.dispose_resources(dev)
-        dev = None
+    dev = None
+
+# list all connected RM200s, returns array of [bus, address] that can be passed to Connect
+def FindDevices():
+    return [[d.bus, d.address] for d in usb.core.find(find_all=True, idVendor=0x0765, idProduct=0x6001)]
+
+# utility function to run a function on every connected RM200 in parallel
+# each device is handled in its own process (as the connection is global), so func
+# must be a module level function, e.g. ForEachDevice(rm.GetTimeToCalibExpired)
+# returns array of [serial, result] for each device, in the order of FindDevices
+# if it fails on a device the result is the exception instead, and serial is 'bus:address' if it couldn't be read
+def ForEachDevice(func, *args):
+    devices = FindDevices()
+    if len(devices) == 0:
+        raise Exception('No RM200 found')
+
+    with concurrent.futures.ProcessPoolExecutor(len(devices)) as pool:
+        futures = [pool.submit(_RunOnDevice, d[0], d[1], func, args) for d in devices]
+        results = []
+        for d, f in zip(devices, futures):
+            try:
+                results.append(f.result())
+            except Exception as e:
+                # worker process died, or the result couldn't be sent back
+                results.append([str(d[0]) + ':' + str(d[1]), e])
+        return results
+
+def _RunOnDevice(bus, address, func, args):
+    serial = None
+    try:
+        Connect(bus, address)
+        serial = GetSerialNum()
+        return [serial, func(*args)]
+    except Exception as e:
+        return [serial if serial != None else str(bus) + ':' + str(address), e]
+    finally:
+        Disconnect()
 
 # enable some debugging in this code
 def SetDebug(enabled):
     global debug
     debug = enabled
 
+# record all usb traffic (requests, responses and timings) to a binary trace file
+# the trace can be replayed later, without the device, using ConnectReplay
+def StartTrace(file):
+    global dev
+
+    if dev is None:
+        raise Exception('Not connected. Call Connect() first.')
+    if isinstance(dev, _TraceRecorder):
+        raise Exception('Already tracing, call StopTrace() first')
+
+    dev = _TraceRecorder(dev, file)
+
+# stop recording a trace, does nothing if not tracing
+def StopTrace():
+    global dev
+    if isinstance(dev, _TraceRecorder):
+        dev.Close()
+        dev = dev.dev
+
+# use a trace recorded by StartTrace in place of a real device
+# the library must make the same requests, in the same order, as when it was recorded
+# realtime=True waits as long as the device took for each transfer, False replays as fast as possible
+def ConnectReplay(file, realtime = True):
+    global dev
+    global commsize
+
+    Disconnect()
+    dev = _ReplayDevice(file, realtime)
+    commsize = dev.commsize
+
+# trace file is a header: 'RM2T', version byte, 32bit commsize
+# then a record per usb transfer: op byte, 32bit microseconds since end of previous transfer,
+# 32bit microseconds the transfer took, 32bit length, then that many bytes of data
+# op is 1=control transfer (data is bRequest, wValue, wIndex), 2=write, 3=read, with 0x80 set if
+# the transfer failed (data is the error message)
+_trace_magic = b'RM2T\x01'
+_trace_record = struct.Struct('<BIII')
+_trace_ctrl = struct.Struct('<BHH')
+
+# wraps a usb device, passing everything through but writing it to the trace file
+class _TraceRecorder:
+    def __init__(self, dev, file):
+        self.dev = dev
+        # buffered here rather than by the file, so a forked process (e.g. ForEachDevice) that
+        # inherits the recorder can drop it without writing the buffer to the file a second time
+        self.pid = os.getpid()
+        self.f = open(file, 'wb', buffering=0)
+        self.buffer = bytearray(_trace_magic + commsize.to_bytes(4, 'little'))
+        self.last = time.perf_counter_ns()
+        # don't lose the buffered end of the trace if the program exits while tracing
+        atexit.register(self.Close)
+
+    def Record(self, op, func, data):
+        start = time.perf_counter_ns()
+        try:
+            ret = func()
+        except usb.core.USBError as e:
+            end = time.perf_counter_ns()
+            self.Write(op | 0x80, start, end, str(e).encode('utf8'))
+            raise
+        end = time.perf_counter_ns()
+        self.Write(op, start, end, ret if op == 3 else data)
+        return ret
+
+    def Write(self, op, start, end, data):
+        self.buffer += _trace_record.pack(op, min((start - self.last) // 1000, 0xffffffff),
+                                          min((end - start) // 1000, 0xffffffff), len(data))
+        self.buffer += data
+        self.last = end
+        if len(self.buffer) >= 1 << 16:
+            self.Flush()
+
+    def Flush(self):
+        if os.getpid() == self.pid:
+            self.f.write(self.buffer)
+        self.buffer.clear()
+
+    def ctrl_transfer(self, bmRequestType, bRequest, wValue = 0, wIndex = 0, data_or_wLength = None, timeout = None):
+        return self.Record(1, lambda: self.dev.ctrl_transfer(bmRequestType, bRequest, wValue, wIndex, data_or_wLength, timeout),
+                           _trace_ctrl.pack(bRequest, wValue, wIndex))
+
+    def write(self, endpoint, data, timeout = None):
+        return self.Record(2, lambda: self.dev.write(endpoint, data, timeout), bytes(data))
+
+    def read(self, endpoint, size_or_buffer, timeout = None):
+        return self.Record(3, lambda: self.dev.read(endpoint, size_or_buffer, timeout), None)
+
+    def Close(self):
+        atexit.unregister(self.Close)
+        self.Flush()
+        self.f.close()
+
+# pretends to be a usb device, answering from a trace file
+class _ReplayDevice:
+    def __init__(self, file, realtime):
+        self.realtime = realtime
+        with open(file, 'rb') as f:
+            data = f.read()
+
+        if data[:len(_trace_magic)] != _trace_magic:
+            raise Exception('Not an RM200 trace file')
+        pos = len(_trace_magic)
+        self.commsize = int.from_bytes(data[pos:pos+4], 'little')
+        pos += 4
+
+        # a trace cut short (e.g. program killed while tracing) ends with a partial record, which is dropped
+        self.truncated = False
+        self.records = collections.deque()
+        while pos < len(data):
+            if pos + _trace_record.size > len(data):
+                self.truncated = True
+                break
+            [op, gap, duration, length] = _trace_record.unpack_from(data, pos)
+            pos += _trace_record.size
+            if pos + length > len(data):
+                self.truncated = True
+                break
+            self.records.append([op, duration, data[pos:pos+length]])
+            pos += length
+
+    def Next(self, op, data):
+        if len(self.records) == 0:
+            if self.truncated:
+                raise Exception('Replay went past the end of the trace (the trace file is truncated)')
+            raise Exception('Replay went past the end of the trace')
+        [recorded_op, duration, recorded] = self.records.popleft()
+
+        if recorded_op & 0x7f != op or (data != None and data != recorded and not recorded_op & 0x80):
+            raise Exception('Replay differs from trace, expected op ' + str(recorded_op & 0x7f) + ' ' + recorded.hex() +
+                            ', got op ' + str(op) + ' ' + (data.hex() if data != None else ''))
+
+        if self.realtime:
+            time.sleep(duration / 1000000)
+
+        if recorded_op & 0x80:
+            raise usb.core.USBError(recorded.decode('utf8'))
+        return recorded
+
+    def ctrl_transfer(self, bmRequestType, bRequest, wValue = 0, wIndex = 0, data_or_wLength = None, timeout = None):
+        self.Next(1, _trace_ctrl.pack(bRequest, wValue, wIndex))
+        return 0
+
+    def write(self, endpoint, data, timeout = None):
+        self.Next(2, bytes(data))
+        return len(data)
+
+    def read(self, endpoint, size_or_buffer, timeout = None):
+        return array.array('B', self.Next(3, None))
+
 def GetComBufSize():
     # remember this value for our use as well
     global commsize
@@ -400,7 +611,8 @@ def FetchFile(file):
     if not OpenFile(file, 1):
         return None
 
-    data = b''
+    # collect the chunks and join once, appending to bytes gets slow for big files
+    chunks = []
     while True:
         chunk = FileRead()
         if chunk == None or len(chunk) < 4:
@@ -409,12 +621,12 @@ def FetchFile(file):
         chunk_len = int.from_bytes(chunk[:4], "big")
         if chunk_len == 0:
             break
-        data += chunk[4:]
+        chunks.append(chunk[4:])
 
     if not CloseFile(file):
         return False
 
-    return data
+    return b''.join(chunks)
 
 # download a file, save to same named file on pc
 def DownloadFile(file):
@@ -435,7 +647,10 @@ def ReadVersionsDotDat():
     data = FetchFile('Versions.dat')
     if data == None:
         return None
+    return DecodeVersionsDotDat(data)
 
+# decode the contents of Versions.dat, see ReadVersionsDotDat
+def DecodeVersionsDotDat(data):
     pos = 0
     files = []
 
@@ -466,28 +681,33 @@ def ReadVersionsDotDat():
 
 # see ReadVersionsDotDat for data format
 def WriteVersionsDotDat(files):
-    data = b''
-    for f in range(len(files)):
-        file = b''
-        # record length
-        file += (6 + 12 + len(files[f][1].encode('utf8')) + len(files[f][2].encode('utf8')) + len(files[f][3].encode('utf8')) +
-                 len(files[f][4].encode('utf8')) + len(files[f][5].encode('utf8')) + len(files[f][7].encode('utf8'))).to_bytes(4, 'little')
+    return PutFile('Versions.dat', EncodeVersionsDotDat(files))
 
+# encode the contents of Versions.dat, see ReadVersionsDotDat
+def EncodeVersionsDotDat(files):
+    # build a list of parts and join once, appending to bytes gets slow with many files
+    data = []
+    for f in range(len(files)):
+        file = []
         for i in range(8):
             match i:
                 case 0:
                     # file type
-                    file += files[f][i].to_bytes(2, 'little')
+                    file.append(files[f][i].to_bytes(2, 'little'))
                 case 6:
                     # file size
-                    file += files[f][i].to_bytes(4, 'little')
+                    file.append(files[f][i].to_bytes(4, 'little'))
                 case _:
                     # strings
-                    file += len(files[f][i].encode('utf8')).to_bytes(2, 'little')
-                    file += files[f][i].encode('utf8')
-        data += file
+                    string = files[f][i].encode('utf8')
+                    file.append(len(string).to_bytes(2, 'little'))
+                    file.append(string)
 
-    return PutFile('Versions.dat', data)
+        # record length
+        data.append(sum(len(part) for part in file).to_bytes(4, 'little'))
+        data.extend(file)
+
+    return b''.join(data)
 
 # save screenshot to bmp file
 def SaveScreenshot(file):
@@ -512,6 +732,156 @@ def SaveScreenshot(file):
 
     return True
 
+# utility function to mirror the screen live to a browser, at http://localhost:port
+# polls the screen rate times a second and compares each frame with the last in tiles (tile must divide
+# 176 and 220, e.g. 11, 22 or 44), the browser is only sent tiles that changed and nothing for identical frames
+# only listens on localhost, runs until interrupted (ctrl-c)
+def MirrorLcd(port = 8200, rate = 5, tile = 22):
+    _RequireNumpy()
+    if 176 % tile != 0 or 220 % tile != 0:
+        raise Exception('Tile size must divide 176 and 220, e.g. 11, 22 or 44')
+
+    mirror = _LcdMirror(tile)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), _LcdMirrorHandler)
+    server.daemon_threads = True
+    server.mirror = mirror
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print('Mirroring screen on http://localhost:' + str(port) + '/')
+
+    try:
+        while True:
+            start = time.perf_counter()
+            data = GetLcdData()
+            if data != None and len(data) == 77440:
+                mirror.Update(bytes(data))
+            time.sleep(max(0, 1 / rate - (time.perf_counter() - start)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
+
+# keeps the last screen frame, and the frame number each tile last changed in
+class _LcdMirror:
+    def __init__(self, tile):
+        self.tile = tile
+        self.tiles_x = 176 // tile
+        self.tiles_y = 220 // tile
+        self.frame = None
+        self.data = None
+        self.seq = 0
+        self.tile_seq = np.zeros((self.tiles_y, self.tiles_x), np.uint32)
+        self.changed = threading.Condition()
+        # per tile in a delta: x, y, then pixels (RGB565 little endian, row by row)
+        self.tile_dtype = np.dtype([('x', 'u1'), ('y', 'u1'), ('pixels', '<u2', (tile, tile))])
+
+    def Tiles(self, frame):
+        return frame.reshape(self.tiles_y, self.tile, self.tiles_x, self.tile).swapaxes(1, 2)
+
+    def Update(self, data):
+        # identical frames are the common case, skip them before doing any tile work
+        if data == self.data:
+            return
+
+        frame = np.frombuffer(data, '<u2').reshape(220, 176)
+        with self.changed:
+            self.seq += 1
+            if self.frame is None:
+                self.tile_seq[:] = self.seq
+            else:
+                self.tile_seq[(self.Tiles(frame) != self.Tiles(self.frame)).any(axis=(2, 3))] = self.seq
+            self.frame = frame
+            self.data = data
+            self.changed.notify_all()
+
+    # wait (up to timeout) for a frame newer than since, returns the tiles changed since then as
+    # 32bit frame number, 16bit tile count, 8bit tile size, then each tile, or None if no change
+    def Delta(self, since, timeout):
+        with self.changed:
+            self.changed.wait_for(lambda: self.seq != since, timeout)
+            if self.seq == since:
+                return None
+
+            # since is from a later frame if the mirror was restarted, so send everything
+            if since > self.seq:
+                since = 0
+            [ys, xs] = np.nonzero(self.tile_seq > since)
+            tiles = np.empty(len(ys), self.tile_dtype)
+            tiles['x'] = xs
+            tiles['y'] = ys
+            tiles['pixels'] = self.Tiles(self.frame)[ys, xs]
+            return struct.pack('<IHB', self.seq, len(tiles), self.tile) + tiles.tobytes()
+
+class _LcdMirrorHandler(http.server.BaseHTTPRequestHandler):
+    page = b"""<!DOCTYPE html>
+<html><head><title>RM200 screen</title></head>
+<body style="background:#333">
+<canvas id="lcd" width="176" height="220" style="width:352px;height:440px;image-rendering:pixelated"></canvas>
+<script>
+const ctx = document.getElementById('lcd').getContext('2d');
+let seq = 0;
+async function poll() {
+    for (;;) {
+        try {
+            const r = await fetch('/delta?since=' + seq);
+            if (r.status != 200) continue;
+            const d = new DataView(await r.arrayBuffer());
+            seq = d.getUint32(0, true);
+            const count = d.getUint16(4, true), tile = d.getUint8(6);
+            let pos = 7;
+            for (let i = 0; i < count; i++) {
+                const x = d.getUint8(pos), y = d.getUint8(pos + 1);
+                pos += 2;
+                const img = ctx.createImageData(tile, tile);
+                for (let p = 0; p < tile * tile; p++, pos += 2) {
+                    const v = d.getUint16(pos, true);
+                    img.data[p * 4] = (v >> 11) * 255 / 31;
+                    img.data[p * 4 + 1] = ((v >> 5) & 63) * 255 / 63;
+                    img.data[p * 4 + 2] = (v & 31) * 255 / 31;
+                    img.data[p * 4 + 3] = 255;
+                }
+                ctx.putImageData(img, x * tile, y * tile);
+            }
+        } catch (e) {
+            await new Promise(done => setTimeout(done, 1000));
+        }
+    }
+}
+poll();
+</script>
+</body></html>
+"""
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path == '/':
+            self.Send(200, 'text/html', self.page)
+        elif url.path == '/delta':
+            try:
+                since = int(urllib.parse.parse_qs(url.query).get('since', ['0'])[0])
+            except ValueError:
+                since = 0
+            delta = self.server.mirror.Delta(since, 10)
+            if delta == None:
+                self.Send(204, None, b'')
+            else:
+                self.Send(200, 'application/octet-stream', delta)
+        else:
+            self.Send(404, 'text/plain', b'Not found')
+
+    def Send(self, status, content_type, body):
+        self.send_response(status)
+        if content_type != None:
+            self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if debug == True:
+            super().log_message(format, *args)
+
 # briefly display a picture on the screen
 # needs raw RBG565 data 176 x -220 pixels
 def Display565Image(file):
@@ -613,10 +983,17 @@ def GetNumberOfEntries():
 # returns array of 11 strings: date/time, fandeck, colour code, page, row, column, colour name, ??, page code, ??, ??
 #   and 1 byte array containing image in BGR565 (not RGB565)
 def GetRecordData(num):
-    data = CommandData(b'\x78\x20' +  num.to_bytes(2, 'big'))
+    data = GetRecordRaw(num)
     if data == None:
         return None
+    return DecodeRecordData(data)
+
+# fetches the undecoded data of a saved sample, see DecodeRecordData
+def GetRecordRaw(num):
+    return CommandData(b'\x78\x20' +  num.to_bytes(2, 'big'))
 
+# decode the raw data of a saved sample, see GetRecordData for the format returned
+def DecodeRecordData(data):
     pos = 0
     record = []
 
@@ -651,6 +1028,18 @@ def GetRecordData(num):
 # save the image from a saved sample record
 # pass the record returned by GetRecordData and a filename to write to
 def SaveRecordImage(record, file):
+    bmp = GetRecordImageBmp(record)
+    if bmp == None:
+        return False
+
+    with open(file, 'wb') as f:
+        f.write(bmp)
+
+    return True
+
+# get the image from a saved sample record as bmp file data
+# pass the record returned by GetRecordData
+def GetRecordImageBmp(record):
     header = bytes([
         0x42, 0x4d, 0xaa, 0x4e, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x8a, 0x00, 0x00, 0x00, 0x7c, 0x00,
         0x00, 0x00, 0x64, 0x00, 0x00, 0x00, 0x9c, 0xff, 0xff, 0xff, 0x01, 0x00, 0x10, 0x00, 0x03, 0x00,
@@ -664,20 +1053,226 @@ def SaveRecordImage(record, file):
     ])
 
     if (len(record) != 12 or record[11] == None):
-        return False
+        return None
 
-    with open(file, 'wb') as f:
-        f.write(header)
-        f.write(record[11])
+    return header + bytes(record[11])
+
+# column names used by ExportRecords: device serial, record number, the 11 strings of GetRecordData, thumbnail
+export_fields = ['device', 'number', 'datetime', 'fandeck', 'colour_code', 'page', 'row', 'column', 'colour_name',
+                 'unknown1', 'page_code', 'unknown2', 'unknown3', 'thumbnail']
+
+# utility function to export all saved samples to a file, format is 'csv', 'jsonl' (json lines) or 'parquet' (needs pyarrow)
+# fetching from the device (in a thread) overlaps with decoding (in a pool of worker processes) and writing,
+# the fetching stops when it's queue_size records ahead so memory use is bounded
+# records are written in order, with columns as per export_fields, thumbnail is a base64 encoded bmp
+# returns dict of stats for each stage (fetch, decode, write, total): records, busy seconds, records per second
+def ExportRecords(file, format = 'csv', workers = None, queue_size = 64):
+    # open the output first, so a bad format or path fails before the device is touched
+    writer = _RecordWriter(file, format)
+    items = queue.Queue(queue_size)
+    stop = threading.Event()
+    fetch_stats = [0, 0.0]
+    errors = []
+
+    def Fetch():
+        try:
+            _FetchRecords(items, serial, fetch_stats, stop)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            _PutUnlessStopped(items, None, stop)
+
+    try:
+        serial = GetSerialNum()
+        reader = threading.Thread(target=Fetch, daemon=True)
+        reader.start()
+        try:
+            stats = _ExportFromQueue(items, 1, writer, workers, queue_size)
+        finally:
+            # if the export failed, make sure the reader is finished with the device before returning
+            stop.set()
+            reader.join()
+    finally:
+        writer.Close()
+
+    if len(errors) > 0:
+        raise errors[0]
+
+    stats['fetch'] = _StageStats(fetch_stats[0], fetch_stats[1])
+    return stats
+
+# utility function to export all saved samples from every connected device to one file, see ExportRecords
+# each device is read from its own process (see ForEachDevice), records from each device are in order
+# but the devices are interleaved, if any device fails the others are still exported before raising
+def ExportRecordsAll(file, format = 'csv', workers = None, queue_size = 64):
+    devices = FindDevices()
+    if len(devices) == 0:
+        raise Exception('No RM200 found')
 
-    return True
+    writer = _RecordWriter(file, format)
+    try:
+        with multiprocessing.Manager() as manager:
+            items = manager.Queue(queue_size)
+            stop = manager.Event()
+            with concurrent.futures.ProcessPoolExecutor(len(devices)) as pool:
+                futures = [pool.submit(_FetchRecordsDevice, d[0], d[1], items, stop) for d in devices]
+                try:
+                    stats = _ExportFromQueue(items, len(devices), writer, workers, queue_size)
+                finally:
+                    # readers check this, so they stop if the export failed
+                    stop.set()
+                results = [f.result() for f in futures]
+    finally:
+        writer.Close()
+
+    # devices are read in parallel, so overall fetch rate is limited by the slowest
+    stats['fetch'] = _StageStats(sum(r[0] for r in results), max(r[1] for r in results))
+    return stats
+
+# reads one device for ExportRecordsAll, always ends with a None on the queue (even if it
+# can't connect) so the export doesn't wait for it forever
+def _FetchRecordsDevice(bus, address, items, stop):
+    try:
+        Connect(bus, address)
+        fetch_stats = [0, 0.0]
+        _FetchRecords(items, GetSerialNum(), fetch_stats, stop)
+        return fetch_stats
+    finally:
+        Disconnect()
+        _PutUnlessStopped(items, None, stop)
+
+# puts [serial, number, raw data] for each saved sample on the queue, the caller must
+# put None when done, gives up as soon as stop is set, even if waiting for space on the queue
+def _FetchRecords(items, serial, fetch_stats, stop):
+    count = GetNumberOfEntries()
+    if count == None:
+        raise Exception('Failed to get number of records')
+
+    for num in range(count):
+        if stop.is_set():
+            return
+
+        start = time.perf_counter()
+        data = GetRecordRaw(num)
+        fetch_stats[1] += time.perf_counter() - start
+        if data == None:
+            raise Exception('Failed to get record ' + str(num))
+
+        if not _PutUnlessStopped(items, [serial, num, bytes(data)], stop):
+            return
+        fetch_stats[0] += 1
+
+def _PutUnlessStopped(items, item, stop):
+    while not stop.is_set():
+        try:
+            items.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def _DecodeExportRecord(item):
+    start = time.perf_counter()
+    record = DecodeRecordData(item[2])
+    bmp = GetRecordImageBmp(record)
+    row = dict(zip(export_fields, [item[0], item[1]] + record[:11] + [base64.b64encode(bmp).decode('ascii')]))
+    return [row, time.perf_counter() - start]
+
+# decode and write everything on the queue until a None has been received from each source
+def _ExportFromQueue(items, sources, writer, workers, queue_size):
+    decode_stats = [0, 0.0]
+    write_stats = [0, 0.0]
+    start = time.perf_counter()
+
+    def WriteResult(future):
+        [row, seconds] = future.result()
+        decode_stats[0] += 1
+        decode_stats[1] += seconds
+
+        write_start = time.perf_counter()
+        writer.Write(row)
+        write_stats[0] += 1
+        write_stats[1] += time.perf_counter() - write_start
+
+    # spawn rather than fork the workers, as the fetching thread is already running
+    with concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        pending = collections.deque()
+        finished = 0
+        while finished < sources:
+            item = items.get()
+            if item == None:
+                finished += 1
+                continue
+
+            pending.append(pool.submit(_DecodeExportRecord, item))
+            # write whatever is done, in order, and wait if too much is queued up
+            while len(pending) > 0 and (pending[0].done() or len(pending) > queue_size):
+                WriteResult(pending.popleft())
+
+        while len(pending) > 0:
+            WriteResult(pending.popleft())
+
+    return {'decode': _StageStats(decode_stats[0], decode_stats[1]),
+            'write': _StageStats(write_stats[0], write_stats[1]),
+            'total': _StageStats(write_stats[0], time.perf_counter() - start)}
+
+def _StageStats(records, seconds):
+    return {'records': records, 'seconds': seconds, 'rate': records / seconds if seconds > 0 else 0.0}
+
+# writes export rows to a csv, json lines or parquet file
+class _RecordWriter:
+    def __init__(self, file, format):
+        self.format = format
+        match format:
+            case 'csv':
+                self.f = open(file, 'w', newline='')
+                self.csv = csv.DictWriter(self.f, export_fields)
+                self.csv.writeheader()
+            case 'jsonl':
+                self.f = open(file, 'w')
+            case 'parquet':
+                try:
+                    import pyarrow
+                    import pyarrow.parquet
+                except ImportError:
+                    raise Exception('pyarrow is required for parquet export')
+                self.pyarrow = pyarrow
+                self.schema = pyarrow.schema([(name, pyarrow.int32() if name == 'number' else pyarrow.string()) for name in export_fields])
+                self.f = pyarrow.parquet.ParquetWriter(file, self.schema)
+                self.rows = []
+            case _:
+                raise Exception('Format must be csv, jsonl or parquet')
+
+    def Write(self, row):
+        match self.format:
+            case 'csv':
+                self.csv.writerow(row)
+            case 'jsonl':
+                self.f.write(json.dumps(row) + '\n')
+            case 'parquet':
+                self.rows.append(row)
+                if len(self.rows) >= 1000:
+                    self.Flush()
+
+    def Flush(self):
+        if len(self.rows) > 0:
+            self.f.write_table(self.pyarrow.Table.from_pylist(self.rows, self.schema))
+            self.rows = []
+
+    def Close(self):
+        if self.format == 'parquet':
+            self.Flush()
+        self.f.close()
 
 # get array of fandecks on the device
 def GetFandecks():
     data = CommandData(b'\x78\x21')
     if data == None:
         return None
+    return DecodeFandecks(data)
 
+# decode the fandeck list data, see GetFandecks
+def DecodeFandecks(data):
     pos = 0
     fandecks = []
 
@@ -723,13 +1318,87 @@ def SetFandeckActive(name, state):
 def DeleteFandeck(name):
     return CommandBool(b'\x78\x32' + name.encode('utf-16le') + b'\0\0')
 
+# work out the commands needed to get from the current fandecks (as returned by GetFandecks)
+# to the desired state, a dict of fandeck name to 0=disabled, 1=enabled, 2=priority or None=deleted
+# fandecks not in desired are left alone, fandecks not on the device can't be added so are ignored
+# returns array of commands, each an array: ['state', name, state], ['delete', name] or ['reboot']
+# ordered so fandecks are deactivated before being deleted, followed by a single reboot
+def PlanFandecks(current, desired):
+    for state in desired.values():
+        if state != None and state not in [0, 1, 2]:
+            raise Exception('State must be 0=disabled, 1=enabled, 2=priority or None=deleted')
+
+    states = []
+    deletes = []
+
+    for fandeck in current:
+        name = fandeck[0]
+        if name not in desired:
+            continue
+
+        state = desired[name]
+        if state == None:
+            if fandeck[1] != 0:
+                states.append(['state', name, 0])
+            deletes.append(['delete', name])
+        elif fandeck[1] != state:
+            states.append(['state', name, state])
+
+    # deactivations first
+    states.sort(key=lambda c: c[2] != 0)
+
+    commands = states + deletes
+    if len(deletes) > 0:
+        commands.append(['reboot'])
+    return commands
+
+# utility function to set the fandecks to the desired state (see PlanFandecks), only sending the commands needed
+# returns True if all commands succeeded (or none were needed)
+# if a command fails the rest are skipped, but the device is still rebooted if anything was deleted
+def ApplyFandecks(desired):
+    current = GetFandecks()
+    if current == None:
+        return False
+
+    ok = True
+    deleted = False
+    for command in PlanFandecks(current, desired):
+        match command[0]:
+            case 'state':
+                ok = SetFandeckActive(command[1], command[2])
+            case 'delete':
+                ok = DeleteFandeck(command[1])
+                deleted = deleted or ok
+            case 'reboot':
+                break
+        if not ok:
+            break
+
+    # deletes only take effect after a reboot
+    if deleted:
+        _RebootNoReply()
+
+    return ok
+
+# reboot, when the device drops off the bus before replying
+def _RebootNoReply():
+    try:
+        Reboot()
+    except usb.core.USBError:
+        pass
+
+# utility function to apply the same fandeck state to every connected device in parallel
+# returns array of [serial, result] as per ForEachDevice
+def ApplyFandecksAll(desired):
+    return ForEachDevice(ApplyFandecks, desired)
+
 # number of second till device needs calibrating again
 # negative number means calibration is past due
 def GetTimeToCalibExpired():
     data = CommandData(b'\x78\x2e')
     if data == None or len(data) != 4:
         return None
-    return int.from_bytes(data, 'big')
+    return int.from_bytes(data, 'big', signed=True)
 
 # returns 0=not calibrated, 1=calibrated
 def GetCalibrationState():
@@ -738,6 +1407,109 @@ def GetCalibrationState():
         return None
     return data[0]
 
+# utility function to make a binary calibration backup and download it, returns the file contents
+# the name of the dump isn't known, so it is found by comparing the directory listing before and after
+# the backup, and deleted from the device once downloaded so the next backup shows up as new again
+# pass the name if the backup just overwrites an existing dump (which is then left on the device)
+def FetchCalibData(file = None):
+    before = FileDir()
+    if not BackupCalibData(3):
+        return None
+
+    if file != None:
+        return FetchFile(file)
+
+    new = [f for f in FileDir() if f not in before]
+    if len(new) != 1:
+        return None
+
+    data = FetchFile(new[0])
+    FileDelete(new[0])
+    return data
+
+# utility function to get everything needed to compare calibrations
+# returns array of seconds till calibration expires and binary calibration dump
+def GetCalibSnapshot(file = None):
+    return [GetTimeToCalibExpired(), FetchCalibData(file)]
+
+# interpret a binary calibration dump as a numpy array
+# the layout of the dump isn't documented, so it is viewed as a flat array of dtype (little
+# endian 32bit floats by default), trailing bytes that don't make up a whole value are dropped
+def ParseCalibData(data, dtype = '<f4'):
+    _RequireNumpy()
+    dtype = np.dtype(dtype)
+    usable = len(data) - len(data) % dtype.itemsize
+    return np.frombuffer(bytes(data[:usable]), dtype)
+
+# compare calibration snapshots, either across devices (pass the result of ForEachDevice(GetCalibSnapshot))
+# or for one device over time (pass array of [label, snapshot], e.g. label as backup date)
+# each value is scored by its distance from the median of that value over all the snapshots, in (scaled)
+# median absolute deviations, a snapshot is flagged if any value scores over threshold or its calibration has expired
+# needs at least 3 dumps (with 2 the median is halfway between them, so neither can score high), to
+# compare just a backup with the current calibration use DiffCalibData
+# snapshots without a dump (it or the device failed) are flagged, with score and index None
+# returns array of [label, max score, index of worst value, seconds till calib expires, flagged]
+def CompareCalibData(snapshots, threshold = 6.0, dtype = '<f4'):
+    _RequireNumpy()
+
+    # only snapshots with a dump can be scored
+    scored = [i for i in range(len(snapshots)) if isinstance(snapshots[i][1], list) and snapshots[i][1][1] != None]
+    if len(scored) < 3:
+        raise Exception('Need at least 3 calibration dumps to compare, use DiffCalibData for 2')
+
+    arrays = [ParseCalibData(snapshots[i][1][1], dtype) for i in scored]
+    if any(len(a) != len(arrays[0]) for a in arrays):
+        raise Exception('Calibration dumps differ in size, cannot compare')
+
+    values = np.stack(arrays).astype(np.float64)
+    values[~np.isfinite(values)] = np.nan
+
+    # columns that are all nan (not really floats) give warnings, they just score 0
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        median = np.nanmedian(values, axis=0)
+        deviation = np.abs(values - median)
+        mad = np.nanmedian(deviation, axis=0)
+
+    # values that (nearly) all agree have no spread, so measure those relative to the value instead
+    scale = np.maximum(mad * 1.4826, np.abs(median) * 1e-3)
+    scale = np.nan_to_num(np.maximum(scale, 1e-12), nan=1.0)
+    scores = np.nan_to_num(deviation / scale, nan=0.0)
+
+    worst = np.argmax(scores, axis=1)
+    maxscores = scores[np.arange(len(scored)), worst]
+
+    results = []
+    for i in range(len(snapshots)):
+        snapshot = snapshots[i][1]
+        expiry = snapshot[0] if isinstance(snapshot, list) else None
+        expired = expiry != None and expiry < 0
+        if i in scored:
+            j = scored.index(i)
+            results.append([snapshots[i][0], float(maxscores[j]), int(worst[j]), expiry, bool(maxscores[j] > threshold) or expired])
+        else:
+            results.append([snapshots[i][0], None, None, expiry, True])
+
+    return results
+
+# compare two calibration dumps from the same device (e.g. a backup and the current calibration)
+# returns array of changed value indexes, old values, new values
+def DiffCalibData(old, new, dtype = '<f4'):
+    _RequireNumpy()
+    old = ParseCalibData(old, dtype)
+    new = ParseCalibData(new, dtype)
+    if len(old) != len(new):
+        raise Exception('Calibration dumps differ in size, cannot compare')
+
+    # compare the raw bits, so nan values don't always count as changed
+    size = old.dtype.itemsize
+    changed = np.flatnonzero((old.view(np.uint8).reshape(-1, size) != new.view(np.uint8).reshape(-1, size)).any(axis=1))
+    return [changed, old[changed], new[changed]]
+
+def _RequireNumpy():
+    if np is None:
+        raise Exception('numpy is required for this function')
+
 # Send a command, get data back (or None in case of error)
 # Pass the full command, including any data, as byte sequence
 # Will throw exception if not connected